@@ -1,13 +1,32 @@
-from fastapi import FastAPI, HTTPException, Header
+from fastapi import FastAPI, HTTPException, Header, Response
 import psycopg2 as pg
 import bcrypt
 import jwt 
+import numpy as np
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
+from decimal import Decimal
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
 
-app = FastAPI()
+# Warm-up runs in the background so liveness answers immediately; readiness
+# stays false until it finishes
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    warm_up_task = asyncio.create_task(warm_up())
+    yield
+    warm_up_task.cancel()
+
+app = FastAPI(lifespan=lifespan)
 # run script: fastapi dev main.py
+# production: python serve.py (see serve.py for worker/port settings)
 #aconfigure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -49,13 +68,373 @@ def get_db_connection():
         port=DB_PORT
     )
     return conn
+
+# ------------------SIMILAR CARS INDEX------------------
+# In-memory feature matrix of every car, used to rank "similar available cars"
+# without scanning the car table on each request. Sold cars stay in the matrix
+# (so a sold car can still be used as the query) and are masked out via
+# similar_index["avail"]. Purchases and cancellations flip that mask in place;
+# the whole index is rebuilt after a TTL to pick up writes from other processes.
+SIMILAR_INDEX_TTL_SECONDS = 60
+SIMILAR_WEIGHTS = {
+    "price": 1.0,
+    "mileage": 0.6,
+    "year": 0.8,
+    "make": 1.0,
+    "model": 1.5,
+}
+similar_index = None
+# Availability changes made while a build is reading the car table (one dict
+# per build in progress), applied to the new index before it is installed
+similar_pending_builds = []
+similar_lock = threading.Lock()
+
+def build_similar_index():
+    global similar_index
+    pending = {}
+    with similar_lock:
+        similar_pending_builds.append(pending)
+    started_at = time.monotonic()
+    try:
+        index = load_similar_index()
+    finally:
+        with similar_lock:
+            similar_pending_builds.remove(pending)
+    index["built_at"] = started_at
+    with similar_lock:
+        # Keep a newer snapshot if an overlapping build already installed one
+        if similar_index is not None and similar_index["built_at"] > started_at:
+            return similar_index
+        for car_id, is_avail in pending.items():
+            pos = index["position"].get(car_id)
+            if pos is not None:
+                index["avail"][pos] = is_avail
+        similar_index = index
+    return index
+
+def load_similar_index():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+    SELECT "CAR_ID", "CAR NAME", "IMAGE", "PRICE($)", "MILEAGE", "YEAR", "MAKE", "MODEL", "IS_AVAIL"
+    FROM car ORDER BY "CAR_ID";
+    """)
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+
+    numeric = np.array(
+        [[row[3], row[4], row[5]] for row in rows], dtype=np.float64
+    ).reshape(len(rows), 3)
+    # Fill missing values with the column median so they don't dominate distances
+    medians = np.nanmedian(numeric, axis=0) if len(rows) else np.zeros(3)
+    medians = np.nan_to_num(medians)
+    missing = np.isnan(numeric)
+    numeric[missing] = np.take(medians, np.nonzero(missing)[1])
+    # Scale each column to unit spread; constant columns are left unscaled
+    scale = numeric.std(axis=0) if len(rows) else np.ones(3)
+    scale[scale == 0] = 1.0
+    weights = np.array([SIMILAR_WEIGHTS["price"], SIMILAR_WEIGHTS["mileage"], SIMILAR_WEIGHTS["year"]])
+
+    make_codes = {}
+    model_codes = {}
+    return {
+        "ids": np.array([row[0] for row in rows], dtype=np.int64),
+        "position": {row[0]: i for i, row in enumerate(rows)},
+        "features": numeric / scale * weights,
+        "make": np.array([make_codes.setdefault(row[6], len(make_codes)) for row in rows], dtype=np.int32),
+        "model": np.array([model_codes.setdefault((row[6], row[7]), len(model_codes)) for row in rows], dtype=np.int32),
+        "avail": np.array([bool(row[8]) for row in rows], dtype=bool),
+        # Same shape as the rows returned by /api/cars
+        "rows": [(row[0], row[1], row[2], row[3], row[4]) for row in rows],
+    }
+
+def get_similar_index():
+    index = similar_index
+    if index is None or index["built_at"] + SIMILAR_INDEX_TTL_SECONDS <= time.monotonic():
+        return build_similar_index()
+    return index
+
+def set_similar_availability(car_id: int, is_avail: bool):
+    with similar_lock:
+        for pending in similar_pending_builds:
+            pending[car_id] = is_avail
+        if similar_index is None:
+            return
+        pos = similar_index["position"].get(car_id)
+        if pos is not None:
+            similar_index["avail"][pos] = is_avail
+
+def car_exists(car_id: int):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('SELECT 1 FROM car WHERE "CAR_ID" = %s;', (car_id,))
+    row = cur.fetchone()
+    cur.close()
+    conn.close()
+    return row is not None
+
+def find_similar_cars(car_id: int, limit: int):
+    index = get_similar_index()
+    pos = index["position"].get(car_id)
+    if pos is None:
+        # Only rebuild for a car added after the index was built, so unknown
+        # ids can't force a full table scan on every request
+        if not car_exists(car_id):
+            return None
+        index = build_similar_index()
+        pos = index["position"].get(car_id)
+        if pos is None:
+            return None
+
+    diff = index["features"] - index["features"][pos]
+    dist = np.einsum("ij,ij->i", diff, diff)
+    dist += SIMILAR_WEIGHTS["make"] * (index["make"] != index["make"][pos])
+    dist += SIMILAR_WEIGHTS["model"] * (index["model"] != index["model"][pos])
+
+    candidates = np.flatnonzero(index["avail"] & (index["ids"] != car_id))
+    if limit <= 0 or candidates.size == 0:
+        return []
+    if candidates.size > limit:
+        top = np.argpartition(dist[candidates], limit - 1)[:limit]
+        candidates = candidates[top]
+    candidates = candidates[np.argsort(dist[candidates], kind="stable")]
+    return [index["rows"][i] for i in candidates]
+
+# ------------------IDEMPOTENCY KEYS------------------
+# Clients may send an "Idempotency-Key" header on write endpoints so that a
+# retried request replays the original outcome instead of running again.
+# Outcomes are kept in a bounded, expiring in-memory store keyed by
+# (scope, key); scope is the endpoint plus the caller, fingerprint is a hash
+# of the request payload so a key can't be reused for a different request.
+IDEMPOTENCY_TTL_SECONDS = 24 * 60 * 60
+IDEMPOTENCY_MAX_KEYS = 10000
+idempotency_store = OrderedDict()
+
+def request_fingerprint(data):
+    encoded = json.dumps(data, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
+
+def purge_expired_entries(store: OrderedDict, max_entries: int, now: float):
+    # Entries are stored in insertion order with a fixed TTL, so the oldest
+    # (and first to expire) are always at the front
+    while store:
+        _, entry = next(iter(store.items()))
+        if entry["expires_at"] > now and len(store) <= max_entries:
+            break
+        store.popitem(last=False)
+
+def save_idempotent_result(store_key, fingerprint, status_code, body):
+    now = time.monotonic()
+    idempotency_store[store_key] = {
+        "fingerprint": fingerprint,
+        "status_code": status_code,
+        "body": body,
+        "expires_at": now + IDEMPOTENCY_TTL_SECONDS,
+    }
+    purge_expired_entries(idempotency_store, IDEMPOTENCY_MAX_KEYS, now)
+
+def run_idempotent(scope: str, idempotency_key: str | None, fingerprint: str, response: Response, action):
+    if not idempotency_key:
+        return action()
+
+    store_key = (scope, idempotency_key)
+    purge_expired_entries(idempotency_store, IDEMPOTENCY_MAX_KEYS, time.monotonic())
+    entry = idempotency_store.get(store_key)
+    if entry:
+        if entry["fingerprint"] != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+        if entry["status_code"] >= 400:
+            raise HTTPException(
+                status_code=entry["status_code"],
+                detail=entry["body"],
+                headers={"Idempotent-Replayed": "true"}
+            )
+        response.headers["Idempotent-Replayed"] = "true"
+        return entry["body"]
+
+    try:
+        result = action()
+    except HTTPException as e:
+        # Server errors are left uncached so the client can retry them
+        if e.status_code < 500:
+            save_idempotent_result(store_key, fingerprint, e.status_code, e.detail)
+        raise
+    if not (isinstance(result, dict) and result.get("error")):
+        save_idempotent_result(store_key, fingerprint, 200, result)
+    return result
+
+# ------------------PROFILE READ MODEL------------------
+# Denormalized per-customer profile (customer fields plus purchase history and
+# a summary) served by GET /api/user/me. It is loaded with one join on first
+# access and then patched in place by the purchase, cancel and profile update
+# endpoints; the TTL bounds staleness from writes made by other processes.
+PROFILE_CACHE_TTL_SECONDS = 60
+PROFILE_CACHE_MAX_ENTRIES = 1000
+profile_cache = OrderedDict()
+
+def purchase_summary(purchases):
+    prices = [p["car_price"] for p in purchases if isinstance(p.get("car_price"), (int, float))]
+    return {
+        "total_purchases": len(purchases),
+        "total_spent": sum(prices),
+    }
+
+def load_profile(username: str):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    query = """
+    SELECT 
+        c.full_name, 
+        c.phone_number, 
+        c.addr, 
+        c.username,
+        c.cust_id,
+        COALESCE(json_agg(
+            json_build_object(
+                'car_id', p.car_id,
+                'car_name', car."CAR NAME",
+                'car_price', car."PRICE($)",
+                'car_image', car."IMAGE"
+            ) ORDER BY p.car_id
+        ) FILTER (WHERE p.car_id IS NOT NULL), '[]'::json) as purchases
+    FROM customer c
+    LEFT JOIN purchase p ON c.cust_id = p.cust_id
+    LEFT JOIN car ON p.car_id = car."CAR_ID"
+    WHERE c.username = %s
+    GROUP BY c.cust_id, c.full_name, c.phone_number, c.addr, c.username;
+    """
+    cur.execute(query, (username,))
+    row = cur.fetchone()
+    cur.close()
+    conn.close()
+
+    if not row:
+        return None
+
+    now = time.monotonic()
+    profile = {
+        "name": row[0],
+        "phone": row[1],
+        "addr": row[2],
+        "username": row[3],
+        "cust_id": row[4],
+        "purchases": list(row[5]),
+        "expires_at": now + PROFILE_CACHE_TTL_SECONDS,
+    }
+    # Re-insert at the end so the cache stays ordered by expiry
+    profile_cache.pop(username, None)
+    profile_cache[username] = profile
+    purge_expired_entries(profile_cache, PROFILE_CACHE_MAX_ENTRIES, now)
+    return profile
+
+def get_profile(username: str):
+    profile = profile_cache.get(username)
+    if profile is None or profile["expires_at"] <= time.monotonic():
+        return load_profile(username)
+    return profile
+
+def profile_add_purchase(username: str, purchase: dict):
+    profile = profile_cache.get(username)
+    if profile is None:
+        return
+    # Match the types json_agg produces for cached purchases (numeric -> float)
+    if isinstance(purchase["car_price"], Decimal):
+        purchase = {**purchase, "car_price": float(purchase["car_price"])}
+    purchases = [p for p in profile["purchases"] if p["car_id"] != purchase["car_id"]]
+    purchases.append(purchase)
+    purchases.sort(key=lambda p: p["car_id"])
+    profile["purchases"] = purchases
+
+def profile_remove_purchase(username: str, car_id: int):
+    profile = profile_cache.get(username)
+    if profile is None:
+        return
+    profile["purchases"] = [p for p in profile["purchases"] if p["car_id"] != car_id]
+
+def profile_update_fields(username: str, updated_user: dict):
+    # A renamed profile is dropped rather than moved, which keeps the cache in
+    # expiry order; the next read under the new username reloads it
+    if updated_user["username"] != username:
+        profile_cache.pop(username, None)
+        return
+    profile = profile_cache.get(username)
+    if profile is not None:
+        profile.update(updated_user)
+
+# ------------------STARTUP AND HEALTH CHECKS------------------
+logger = logging.getLogger("uvicorn.error")
+WARM_UP_RETRY_SECONDS = 5
+REQUIRED_COLUMNS = {
+    "car": ["CAR_ID", "CAR NAME", "IMAGE", "PRICE($)", "MILEAGE", "YEAR", "MAKE", "MODEL", "IS_AVAIL"],
+    "customer": ["cust_id", "full_name", "phone_number", "addr", "username", "pass_hash"],
+    "purchase": ["cust_id", "car_id"],
+}
+server_state = {"ready": False}
+
+def check_schema():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+    SELECT table_name, column_name FROM information_schema.columns
+    WHERE table_schema = current_schema() AND table_name = ANY(%s);
+    """, (list(REQUIRED_COLUMNS),))
+    existing = set(cur.fetchall())
+    cur.close()
+    conn.close()
+
+    missing = [
+        f"{table}.{column}"
+        for table, columns in REQUIRED_COLUMNS.items()
+        for column in columns
+        if (table, column) not in existing
+    ]
+    if missing:
+        raise RuntimeError(f"Missing database columns: {', '.join(missing)}")
+
+def run_warm_up():
+    check_schema()
+    build_similar_index()
+
+async def warm_up():
+    while True:
+        try:
+            await asyncio.to_thread(run_warm_up)
+        except Exception as e:
+            logger.warning("Warm-up failed, retrying in %ss: %s", WARM_UP_RETRY_SECONDS, e)
+            await asyncio.sleep(WARM_UP_RETRY_SECONDS)
+            continue
+        server_state["ready"] = True
+        logger.info("Warm-up complete, ready to serve requests")
+        return
+
+@app.get("/health/live")
+async def liveness():
+    return {"status": "alive"}
+
+@app.get("/health/ready")
+async def readiness():
+    # Warm-up errors are logged, not returned, since they can include connection details
+    if not server_state["ready"]:
+        raise HTTPException(status_code=503, detail="Warming up")
+    return {"status": "ready"}
+
 @app.get("/")
 async def read_root():
     return {"message": "Hello World"}
 # ------------------INSERT OPERATIONS BELOW------------------
 #creating a new customer 
 @app.post('/api/customer/')
-async def insert_customer(user: userSignup):
+async def insert_customer(user: userSignup, response: Response, idempotency_key: str | None = Header(None)):
+    return run_idempotent(
+        "POST /api/customer/",
+        idempotency_key,
+        request_fingerprint(user.model_dump()),
+        response,
+        lambda: create_customer_record(user),
+    )
+
+def create_customer_record(user: userSignup):
     conn = None
     try:
         conn = get_db_connection()
@@ -103,7 +482,12 @@ async def insert_customer(user: userSignup):
     
 # Create a new purchase
 @app.post('/api/purchase')
-async def create_purchase(purchase_data: purchaseRequest, authorization: str = Header(None)):
+async def create_purchase(
+    purchase_data: purchaseRequest,
+    response: Response,
+    authorization: str = Header(None),
+    idempotency_key: str | None = Header(None)
+):
     if not authorization:
         raise HTTPException(status_code=401, detail="Authorization header missing")
     
@@ -120,6 +504,15 @@ async def create_purchase(purchase_data: purchaseRequest, authorization: str = H
     if not username:
         raise HTTPException(status_code=401, detail="Username not found in token")
     
+    return run_idempotent(
+        f"POST /api/purchase:{username}",
+        idempotency_key,
+        request_fingerprint(purchase_data.model_dump()),
+        response,
+        lambda: create_purchase_record(username, purchase_data),
+    )
+
+def create_purchase_record(username: str, purchase_data: purchaseRequest):
     conn = None
     try:
         conn = get_db_connection()
@@ -139,7 +532,7 @@ async def create_purchase(purchase_data: purchaseRequest, authorization: str = H
         
         # Check if car exists and is available
         car_query = """
-        SELECT "CAR_ID", "CAR NAME", "PRICE($)", "IS_AVAIL" 
+        SELECT "CAR_ID", "CAR NAME", "PRICE($)", "IS_AVAIL", "IMAGE" 
         FROM car WHERE "CAR_ID" = %s;
         """
         cur.execute(car_query, (purchase_data.car_id,))
@@ -181,6 +574,13 @@ async def create_purchase(purchase_data: purchaseRequest, authorization: str = H
         conn.commit()
         cur.close()
         conn.close()
+        set_similar_availability(purchase_data.car_id, False)
+        profile_add_purchase(username, {
+            "car_id": purchase_data.car_id,
+            "car_name": car_row[1],
+            "car_price": car_row[2],
+            "car_image": car_row[4]
+        })
         
         return {
             "message": "Purchase created successfully",
@@ -326,6 +726,8 @@ async def update_user_info(user_data: userUpdate, authorization: str = Header(No
         if new_token:
             response["new_token"] = new_token
         
+        profile_update_fields(current_username, updated_user)
+        
         return response
         
     except HTTPException:
@@ -408,6 +810,9 @@ async def delete_user_account(authorization: str = Header(None)):
         conn.commit()
         cur.close()
         conn.close()
+        for purchase in purchases or []:
+            set_similar_availability(purchase[0], True)
+        profile_cache.pop(username, None)
         
         return {
             "message": "User account deleted successfully",
@@ -431,7 +836,12 @@ async def delete_user_account(authorization: str = Header(None)):
 
 # Delete a specific purchase (cancel purchase)
 @app.delete('/api/purchase/{car_id}')
-async def delete_purchase(car_id: int, authorization: str = Header(None)):
+async def delete_purchase(
+    car_id: int,
+    response: Response,
+    authorization: str = Header(None),
+    idempotency_key: str | None = Header(None)
+):
     if not authorization:
         raise HTTPException(status_code=401, detail="Authorization header missing")
     
@@ -448,6 +858,15 @@ async def delete_purchase(car_id: int, authorization: str = Header(None)):
     if not username:
         raise HTTPException(status_code=401, detail="Username not found in token")
     
+    return run_idempotent(
+        f"DELETE /api/purchase:{username}",
+        idempotency_key,
+        request_fingerprint({"car_id": car_id}),
+        response,
+        lambda: delete_purchase_record(username, car_id),
+    )
+
+def delete_purchase_record(username: str, car_id: int):
     conn = None
     try:
         conn = get_db_connection()
@@ -491,6 +910,8 @@ async def delete_purchase(car_id: int, authorization: str = Header(None)):
         conn.commit()
         cur.close()
         conn.close()
+        set_similar_availability(car_id, True)
+        profile_remove_purchase(username, car_id)
         
         return {
             "message": "Purchase cancelled successfully",
@@ -527,6 +948,17 @@ async def get_car_details(car_id: int):
     conn.close()
     return row
 
+# Similar available cars, ranked by closeness in price, mileage, year, make and model
+@app.get('/api/car/{car_id}/similar')
+async def get_similar_cars(car_id: int, limit: int = 6):
+    try:
+        rows = find_similar_cars(car_id, min(max(limit, 0), 50))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error finding similar cars: {str(e)}")
+    if rows is None:
+        raise HTTPException(status_code=404, detail="Car not found")
+    return rows
+
 
 
 
@@ -672,8 +1104,9 @@ def decode_jwt_token(token: str):
         raise HTTPException(status_code=401, detail="Invalid token")
 
 # Get user information from token
+# Purchases can be paginated with limit/offset; without a limit the full history is returned
 @app.get('/api/user/me')
-async def get_user_info(authorization: str = Header(None)):
+async def get_user_info(authorization: str = Header(None), limit: int | None = None, offset: int = 0):
     if not authorization:
         raise HTTPException(status_code=401, detail="Authorization header missing")
     
@@ -690,58 +1123,34 @@ async def get_user_info(authorization: str = Header(None)):
     if not username:
         raise HTTPException(status_code=401, detail="Username not found in token")
     
-    # Get user information from database
-    conn = None
+    if offset < 0 or (limit is not None and limit < 0):
+        raise HTTPException(status_code=400, detail="limit and offset must not be negative")
+    
+    # Get user information from the cached profile (loaded from database on a miss)
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        # Get user information along with purchase data
-        query = """
-        SELECT 
-            c.full_name, 
-            c.phone_number, 
-            c.addr, 
-            c.username,
-            c.cust_id,
-            COALESCE(json_agg(
-                json_build_object(
-                    'car_id', p.car_id,
-                    'car_name', car."CAR NAME",
-                    'car_price', car."PRICE($)",
-                    'car_image', car."IMAGE"
-                ) ORDER BY p.car_id
-            ) FILTER (WHERE p.car_id IS NOT NULL), '[]'::json) as purchases
-        FROM customer c
-        LEFT JOIN purchase p ON c.cust_id = p.cust_id
-        LEFT JOIN car ON p.car_id = car."CAR_ID"
-        WHERE c.username = %s
-        GROUP BY c.cust_id, c.full_name, c.phone_number, c.addr, c.username;
-        """
-        cur.execute(query, (username,))
-        row = cur.fetchone()
-        cur.close()
-        conn.close()
-        
-        if not row:
-            raise HTTPException(status_code=404, detail="User not found")
-        
-        # Return user information with purchases (excluding password)
-        user_info = {
-            "name": row[0],
-            "phone": row[1],
-            "addr": row[2],
-            "username": row[3],
-            "cust_id": row[4],
-            "purchases": row[5]
-        }
-        
-        return {"user": user_info, "message": "User information retrieved successfully"}
-        
+        profile = get_profile(username)
+        if profile:
+            purchases = profile["purchases"]
+            page = purchases[offset:] if limit is None else purchases[offset:offset + limit]
+            summary = purchase_summary(purchases)
     except Exception as e:
-        if conn:
-            conn.close()
         raise HTTPException(status_code=500, detail=f"Error retrieving user information: {str(e)}")
+    
+    if not profile:
+        raise HTTPException(status_code=404, detail="User not found")
+    
+    # Return user information with purchases (excluding password)
+    user_info = {
+        "name": profile["name"],
+        "phone": profile["phone"],
+        "addr": profile["addr"],
+        "username": profile["username"],
+        "cust_id": profile["cust_id"],
+        "purchases": page,
+        "purchase_summary": summary
+    }
+    
+    return {"user": user_info, "message": "User information retrieved successfully"}
 
 
 
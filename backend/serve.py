@@ -0,0 +1,25 @@
+import os
+import uvicorn
+
+# Production entry point: python serve.py
+# Runs uvicorn worker processes, each warming its own caches on startup (see
+# lifespan in main.py). Settings can be overridden with environment variables.
+HOST = os.environ.get("HOST", "0.0.0.0")
+PORT = int(os.environ.get("PORT", 8000))
+# Idempotency keys, the similar-cars index and cached profiles live in each
+# worker's memory and are not shared, so more than one worker means retries
+# may run twice and reads may be up to a minute stale across workers
+WORKERS = int(os.environ.get("WEB_CONCURRENCY", 1))
+# Seconds to wait for in-flight requests (e.g. purchases) to finish on shutdown
+GRACEFUL_TIMEOUT = int(os.environ.get("GRACEFUL_TIMEOUT", 30))
+
+if __name__ == "__main__":
+    uvicorn.run(
+        "main:app",
+        app_dir=os.path.dirname(os.path.abspath(__file__)),
+        host=HOST,
+        port=PORT,
+        workers=WORKERS,
+        timeout_graceful_shutdown=GRACEFUL_TIMEOUT,
+        proxy_headers=True,
+    )